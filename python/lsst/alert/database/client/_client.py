@@ -18,34 +18,350 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import asyncio
+import contextlib
+import functools
+import gzip as _stdlib_gzip
 import io
-import json
-import gzip
-import struct
+import os
+import tempfile
+import threading
 import urllib
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from gzip import BadGzipFile
+from pathlib import Path
+from typing import IO, Any, Callable, Dict, Iterable, Iterator, List, Optional, Union
 
 import fastavro
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from ._columnar import ForthProgram, compile_forth_program, parse_alert_headers
+
+try:
+    # ISA-L's SIMD DEFLATE implementation is a drop-in replacement for the
+    # standard library's gzip module, and considerably faster.
+    from isal import igzip as gzip
+except ImportError:
+    import gzip
+
+try:
+    from isal import isal_zlib as zlib
+except ImportError:
+    import zlib
+
+try:
+    # orjson parses the (large) alert schema documents several times faster
+    # than the standard library, and accepts bytes directly.
+    import orjson as _json
+except ImportError:
+    import json as _json
+
+# Compressed payloads larger than this are decompressed with rapidgzip when
+# parallel decompression is requested. Below this size, the overhead of
+# spinning up worker threads outweighs any gain.
+_PARALLEL_DECOMPRESS_THRESHOLD = 1 << 20
+
+# Alert packets are downloaded and decompressed in pieces of this size.
+_CHUNK_SIZE = 1 << 16
+
+_GZIP_MAGIC = b"\x1f\x8b"
+
+_SchemaReader = Callable[[IO[bytes]], Any]
+
+
+def _gzip_decompress(data: bytes) -> bytes:
+    try:
+        return gzip.decompress(data)
+    except Exception:
+        pass
+    # ISA-L raises different exceptions from the standard library for some
+    # invalid data - EOFError for data with no gzip header, for example - so
+    # the standard library is rerun to pick the exception. That way, errors
+    # are the same whether or not isal is installed.
+    try:
+        return _stdlib_gzip.decompress(data)
+    except (BadGzipFile, EOFError):
+        raise
+    except Exception as e:
+        raise BadGzipFile(str(e)) from e
+
+
+class _GzipStreamDecompressor:
+    """
+    Decompress gzip data which arrives in pieces.
+
+    Like gzip.decompress, this accepts any number of concatenated gzip
+    members, with optional zero padding between them. It raises BadGzipFile
+    if the data is not valid gzip data, and EOFError if it is truncated.
+    """
+
+    def __init__(self):
+        self._decompressor = None
+        # Undecompressed bytes which don't yet show whether another member
+        # follows.
+        self._pending = b""
+        self._n_members = 0
+        self._output: List[bytes] = []
+
+    def peek(self, n: int) -> bytes:
+        """
+        Return the first n bytes of output, or less if not that much has
+        been decompressed yet.
+        """
+        head = b""
+        for piece in self._output:
+            head += piece[:n - len(head)]
+            if len(head) == n:
+                break
+        return head
+
+    def feed(self, data: bytes):
+        while data:
+            if self._decompressor is None:
+                data = self._pending + data
+                if self._n_members > 0:
+                    data = data.lstrip(b"\x00")
+                if len(data) < len(_GZIP_MAGIC):
+                    self._pending = data
+                    return
+                if data[:2] != _GZIP_MAGIC:
+                    raise BadGzipFile(f"Not a gzipped file ({data[:2]!r})")
+                self._pending = b""
+                self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            try:
+                self._output.append(self._decompressor.decompress(data))
+            except zlib.error as e:
+                raise BadGzipFile(str(e)) from e
+            if not self._decompressor.eof:
+                return
+            data = self._decompressor.unused_data
+            self._decompressor = None
+            self._n_members += 1
+
+    def finish(self) -> bytes:
+        if self._decompressor is not None or self._pending:
+            raise EOFError("Compressed file ended before the end-of-stream marker was reached")
+        return b"".join(self._output)
+
+
+def _compile_reader(schema: dict) -> _SchemaReader:
+    """
+    Build a function which deserializes schemaless Avro data written with
+    the given schema.
+
+    If the optional avroc package is installed, the schema is compiled into
+    a specialized decoder, which is several times faster than fastavro's
+    generic reader. Otherwise, fastavro is used.
+    """
+    try:
+        import avroc
+    except ImportError:
+        parsed = fastavro.parse_schema(schema)
+        return functools.partial(fastavro.schemaless_reader, writer_schema=parsed)
+    return avroc.compile_decoder(schema)
+
+
+class _LRUCache:
+    """
+    A thread-safe mapping which holds at most maxsize entries, evicting the
+    least recently used one when full.
+    """
+
+    def __init__(self, maxsize: int):
+        self._maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                self._data.move_to_end(key)
+            except KeyError:
+                return default
+            return self._data[key]
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            if len(self._data) > self._maxsize:
+                self._data.popitem(last=False)
+
+    def __contains__(self, key) -> bool:
+        with self._lock:
+            return key in self._data
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._data)
 
 
 class Client:
     """
     A client for the alert database. This client provides access to
     archived alert packets and their schemas, fetching them over HTTP.
+
+    Requests are made through a persistent HTTP session, so connections to
+    the alert database are kept alive and reused across calls. Call
+    Client.close (or use the client as a context manager) to release them.
+
+    Parameters
+    ----------
+    url : str
+        Base URL of the alert database server. If no scheme is given,
+        http is assumed.
+    max_connections : int, optional
+        Maximum number of connections to keep open to the server.
+    schema_cache_size : int, optional
+        Maximum number of parsed schemas to keep in memory.
+    cache_dir : str or os.PathLike, optional
+        A directory in which to store schema documents once they have been
+        fetched. Schemas never change once published, so the directory can
+        be shared across processes and reused indefinitely. By default,
+        schemas are only cached in memory.
+    http_backend : str, optional
+        The HTTP library to use, either "requests" (the default) or
+        "httpx". The httpx backend speaks HTTP/2, so that concurrent
+        requests, like those made by Client.get_alerts, are multiplexed
+        over a single connection. It requires the optional httpx and h2
+        packages. Note that HTTP errors are then raised as
+        httpx.HTTPStatusError rather than requests.HTTPError.
+
+    Examples
+    --------
+    Using the client as a context manager closes it when the block exits:
+
+    >>> with Client("https://some_location") as client:
+    ...     packet = client.get_alert(68214)
     """
 
-    def __init__(self, url: str):
-        parsed_url = urllib.parse.urlparse(url)
-        if not parsed_url.scheme:
+    def __init__(
+        self,
+        url: str,
+        max_connections: int = 16,
+        schema_cache_size: int = 128,
+        cache_dir: Optional[Union[str, os.PathLike]] = None,
+        http_backend: str = "requests",
+    ):
+        if "://" not in url:
             url = "http://" + url
         self.url = url
+        # Resolve the endpoint prefixes once, so building a request URL is
+        # just string concatenation.
+        self._alert_url_prefix = urllib.parse.urljoin(url, "/v1/alerts/")
+        self._schema_url_prefix = urllib.parse.urljoin(url, "/v1/schemas/")
+
+        self._max_connections = max_connections
+        if http_backend == "requests":
+            self._session = self._make_session(max_connections)
+        elif http_backend == "httpx":
+            self._session = self._make_httpx_session(max_connections)
+        else:
+            raise ValueError(f"unknown http_backend {http_backend!r}, should be 'requests' or 'httpx'")
+        self._http_backend = http_backend
+        self._schema_cache = _LRUCache(schema_cache_size)
+        self._forth_cache = _LRUCache(schema_cache_size)
+        self._document_cache = _LRUCache(schema_cache_size)
+        # Schemas which are missing from the cache are fetched in the
+        # background. In-flight fetches are tracked in _schema_futures, so
+        # that concurrent callers wait on the same fetch rather than each
+        # making their own.
+        self._executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="alert-db-schema")
+        self._schema_futures: Dict[int, Future] = {}
+        self._schema_futures_lock = threading.Lock()
+        self._forth_lock = threading.Lock()
+        # The most recently used schema ID and its reader. Nearly all alerts
+        # share one schema, so get_alert checks this before the cache. It is
+        # a single tuple so that threads always see a matching pair.
+        self._hot_schema = (None, None)
+        self._closed = False
+        if cache_dir is not None:
+            cache_dir = Path(cache_dir)
+            cache_dir.mkdir(parents=True, exist_ok=True)
+        self._cache_dir = cache_dir
+
+    @staticmethod
+    def _make_session(max_connections: int) -> requests.Session:
+        retries = Retry(
+            total=3,
+            backoff_factor=0.2,
+            status_forcelist=[502, 503, 504],
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=max_connections,
+            max_retries=retries,
+        )
+        session = requests.Session()
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    @staticmethod
+    def _make_httpx_session(max_connections: int):
+        import httpx
+
+        # httpx's default timeout also limits how long a request may wait
+        # for a pooled connection, which a large batch of requests easily
+        # exceeds, so only the network operations themselves are limited.
+
+        limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_connections,
+        )
+        return httpx.Client(
+            transport=httpx.HTTPTransport(http2=True, limits=limits, retries=3),
+            timeout=httpx.Timeout(5.0, pool=None),
+        )
+
+    def _make_async_session(self):
+        import httpx
+
+        limits = httpx.Limits(
+            max_connections=self._max_connections,
+            max_keepalive_connections=self._max_connections,
+        )
+        return httpx.AsyncClient(
+            transport=httpx.AsyncHTTPTransport(http2=True, limits=limits, retries=3),
+            timeout=httpx.Timeout(5.0, pool=None),
+        )
+
+    def close(self):
+        """
+        Close the client's HTTP session, releasing any pooled connections,
+        and stop its background schema fetching threads. The client can't
+        be used once closed.
+        """
+        self._closed = True
+        self._session.close()
+        self._executor.shutdown(wait=False)
+
+    def __enter__(self):
+        return self
 
-        self._schema_cache = {}
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __del__(self):
+        # Best effort only: __init__ may not have finished, and the
+        # interpreter may be shutting down.
+        try:
+            self.close()
+        except Exception:
+            pass
+
+    def _check_open(self):
+        if self._closed:
+            raise RuntimeError("client is closed")
 
     def _get_alert_url(self, alert_id: int) -> str:
-        return urllib.parse.urljoin(self.url, f"/v1/alerts/{alert_id}")
+        return self._alert_url_prefix + str(alert_id)
 
-    def get_raw_alert_bytes(self, alert_id: int) -> bytes:
+    def get_raw_alert_bytes(self, alert_id: int, parallel: bool = False) -> bytes:
         """
         Get the verbatim raw bytes of an alert packet, as sent out over the
         alert stream.
@@ -57,21 +373,84 @@ class Client:
         ----------
         alert_id : int
             The alertId of the packet to retrieve.
+        parallel : bool, optional
+            If true, and the optional rapidgzip package is installed, large
+            packets are decompressed using all available CPU cores. This is
+            only worthwhile for packets of several megabytes.
 
         Returns
         -------
         bytes
             The bytes that were sent when the packet was published.
+
+        Raises
+        ------
+        gzip.BadGzipFile
+            If the packet is not valid gzip data.
+        EOFError
+            If the packet is truncated.
+        RuntimeError
+            If the client has been closed.
         """
+        return self._get_raw_alert_bytes(alert_id, parallel)
 
+    def _get_raw_alert_bytes(
+        self,
+        alert_id: int,
+        parallel: bool = False,
+        on_header: Optional[Callable[[bytes], None]] = None,
+    ) -> bytes:
+        # on_header, if given, is called with the packet's 5-byte header as
+        # soon as it has been decompressed, while the rest of the packet
+        # may still be downloading.
+        self._check_open()
         url = self._get_alert_url(alert_id)
-        response = requests.get(url)
-        response.raise_for_status()
-        decompressed = gzip.decompress(response.content)
-        return decompressed
+        with self._stream(url) as chunks:
+            if parallel:
+                return self._decompress(b"".join(chunks), parallel)
+            # Decompressing each piece as it arrives overlaps decompression
+            # with the download, and never holds the whole compressed
+            # packet in memory.
+            decompressor = _GzipStreamDecompressor()
+            for chunk in chunks:
+                decompressor.feed(chunk)
+                if on_header is not None:
+                    header = decompressor.peek(5)
+                    if len(header) == 5:
+                        on_header(header)
+                        on_header = None
+        return decompressor.finish()
+
+    @contextlib.contextmanager
+    def _stream(self, url: str) -> Iterator[Iterator[bytes]]:
+        # Both backends undo any transport-level Content-Encoding while
+        # iterating over the body, and wrap transfer errors in their own
+        # exception types.
+        if self._http_backend == "httpx":
+            with self._session.stream("GET", url) as response:
+                response.raise_for_status()
+                yield response.iter_bytes(_CHUNK_SIZE)
+        else:
+            with self._session.get(url, stream=True) as response:
+                response.raise_for_status()
+                yield response.iter_content(_CHUNK_SIZE)
+
+    @staticmethod
+    def _decompress(compressed: bytes, parallel: bool = False) -> bytes:
+        if parallel and len(compressed) > _PARALLEL_DECOMPRESS_THRESHOLD:
+            try:
+                import rapidgzip
+            except ImportError:
+                pass
+            else:
+                with rapidgzip.RapidgzipFile(
+                    io.BytesIO(compressed), parallelization=os.cpu_count()
+                ) as f:
+                    return f.read()
+        return _gzip_decompress(compressed)
 
     def _get_schema_url(self, schema_id: int) -> str:
-        return urllib.parse.urljoin(self.url, f"/v1/schemas/{schema_id}")
+        return self._schema_url_prefix + str(schema_id)
 
     def get_schema(self, schema_id: int) -> bytes:
         """
@@ -108,9 +487,9 @@ class Client:
         >>> raw_schema = client.get_schema(schema_id)
         >>> schema = fastavro.parse(json.loads(raw_schema))
         """
-
+        self._check_open()
         url = self._get_schema_url(schema_id)
-        response = requests.get(url)
+        response = self._session.get(url)
         response.raise_for_status()
         return response.content
 
@@ -122,7 +501,9 @@ class Client:
         Client.get_raw_alert_bytes. Then, it uses the alert packet's
         schema ID to get the proper schema, and deserializes the bytes,
         returning the unpacked dictionary structure for the alert
-        packet.
+        packet. A schema which isn't cached yet is fetched in the
+        background as soon as the packet's header arrives, while the rest
+        of the packet downloads.
 
         Parameters
         ----------
@@ -146,22 +527,280 @@ class Client:
         >>> ra, dec = packet["diaSource"]["ra"], packet["diaSource"]["dec"]
         """
 
-        raw_bytes = self.get_raw_alert_bytes(alert_id)
+        raw_bytes = self._get_raw_alert_bytes(alert_id, on_header=self._start_schema_fetch)
+        # This is Client._parse_alert_header, inlined since it runs for every
+        # alert.
         if len(raw_bytes) < 5:
             raise ValueError("corrupted alert data is not in confluent wire format")
-        schema_id = self._parse_alert_header(raw_bytes)
-        alert_payload = raw_bytes[5:]
-        schema = self._get_parsed_schema(schema_id)
-        return fastavro.schemaless_reader(io.BytesIO(alert_payload), schema)
-
-    def _get_parsed_schema(self, schema_id: int) -> dict:
-        if schema_id in self._schema_cache:
-            return self._schema_cache[schema_id]
+        if raw_bytes[0] != 0:
+            raise ValueError("alert header has incorrect magic byte, might be corrupted")
+        schema_id = int.from_bytes(raw_bytes[1:5], "big")
+        hot_schema_id, reader = self._hot_schema
+        if schema_id != hot_schema_id:
+            reader = self._get_schema_reader(schema_id)
+            self._hot_schema = (schema_id, reader)
+        # BytesIO shares the buffer of a bytes object instead of copying it,
+        # so seeking past the header avoids copying the payload.
+        payload = io.BytesIO(raw_bytes)
+        payload.seek(5)
+        return reader(payload)
+
+    def get_alerts(self, alert_ids: Iterable[int]) -> Iterator[dict]:
+        """
+        Retrieve and deserialize many archived alert packets.
+
+        Alerts are fetched concurrently over the client's pooled
+        connections, using up to max_connections worker threads. Results
+        are yielded in the same order as alert_ids.
+
+        Parameters
+        ----------
+        alert_ids : Iterable[int]
+            The alertIds of the alert packets to retrieve.
+
+        Yields
+        ------
+        dict
+            Fully deserialized alert packets.
+
+        Raises
+        ------
+        ValueError
+            If an alert packet is corrupted.
+
+        Examples
+        --------
+        >>> client = Client("https://some_location")
+        >>> for packet in client.get_alerts([68214, 68215, 68216]):
+        ...     print(packet["alertId"])
+        """
+        with ThreadPoolExecutor(max_workers=self._max_connections) as executor:
+            yield from executor.map(self.get_alert, alert_ids)
+
+    async def get_alerts_async(self, alert_ids: Iterable[int]) -> List[dict]:
+        """
+        Retrieve and deserialize many archived alert packets, concurrently,
+        from within an asyncio event loop.
+
+        Up to max_connections alerts are requested at once over HTTP/2, so
+        they are multiplexed over as few connections as possible. This
+        requires the optional httpx and h2 packages, regardless of
+        http_backend.
+
+        Parameters
+        ----------
+        alert_ids : Iterable[int]
+            The alertIds of the alert packets to retrieve.
+
+        Returns
+        -------
+        list[dict]
+            Fully deserialized alert packets, in the same order as
+            alert_ids.
+
+        Raises
+        ------
+        ValueError
+            If an alert packet is corrupted.
+        httpx.HTTPStatusError
+            If an alert could not be retrieved.
+
+        Examples
+        --------
+        >>> client = Client("https://some_location")
+        >>> packets = asyncio.run(client.get_alerts_async([68214, 68215]))
+        """
+        self._check_open()
+        loop = asyncio.get_running_loop()
+        # Limit the number of requests in flight here, rather than queuing
+        # all of them inside httpx's connection pool.
+        semaphore = asyncio.Semaphore(self._max_connections)
+
+        async def fetch(session, alert_id: int) -> bytes:
+            async with semaphore:
+                response = await session.get(self._get_alert_url(alert_id))
+            response.raise_for_status()
+            # Decompress in a worker thread, so that large packets don't hold
+            # up the other downloads.
+            raw_bytes = await loop.run_in_executor(None, self._decompress, response.content)
+            # Start fetching a new schema right away, while other alerts are
+            # still downloading.
+            schema_id = self._parse_alert_header(raw_bytes)
+            if schema_id not in self._schema_cache:
+                self._prefetch_schema(schema_id)
+            return raw_bytes
+
+        async with self._make_async_session() as session:
+            raw_alerts = await asyncio.gather(*(fetch(session, alert_id) for alert_id in alert_ids))
+
+        alerts = []
+        for raw_bytes in raw_alerts:
+            schema_id = int.from_bytes(raw_bytes[1:5], "big")
+            reader = self._schema_cache.get(schema_id)
+            if reader is None:
+                reader = await asyncio.wrap_future(self._prefetch_schema(schema_id))
+            payload = io.BytesIO(raw_bytes)
+            payload.seek(5)
+            alerts.append(reader(payload))
+        return alerts
+
+    def get_alerts_columnar(self, alert_ids: Iterable[int]):
+        """
+        Retrieve many archived alert packets as a single columnar Awkward
+        Array.
+
+        Alerts are fetched concurrently, like with Client.get_alerts. Their
+        payloads are then decoded in bulk with AwkwardForth, directly into
+        one array per field, rather than into a dictionary per alert. This
+        is much faster for large batches, and gives vectorized access to
+        fields across all of the alerts.
+
+        Unlike Client.get_alert, Avro logical types are not applied: for
+        example, a timestamp-millis field holds integer milliseconds rather
+        than datetimes.
+
+        This requires the optional awkward package.
+
+        Parameters
+        ----------
+        alert_ids : Iterable[int]
+            The alertIds of the alert packets to retrieve.
+
+        Returns
+        -------
+        awkward.Array
+            The deserialized alert packets, in the same order as alert_ids.
+            If alert_ids is empty, there is no schema to take fields from,
+            so this is an empty array with no fields.
+
+        Raises
+        ------
+        ValueError
+            If an alert packet is corrupted, or its schema cannot be decoded
+            columnarly.
+
+        Examples
+        --------
+        >>> client = Client("https://some_location")
+        >>> packets = client.get_alerts_columnar([68214, 68215, 68216])
+        >>> ra, dec = packets["diaSource", "ra"], packets["diaSource", "dec"]
+        """
+        import awkward as ak
+        import numpy as np
+
+        with ThreadPoolExecutor(max_workers=self._max_connections) as executor:
+            raw_alerts = list(executor.map(self.get_raw_alert_bytes, alert_ids))
+
+        if len(raw_alerts) == 0:
+            return ak.Array([])
+
+        # Lay all of the packets out in one buffer, and parse all of their
+        # headers at once.
+        flat = np.frombuffer(b"".join(raw_alerts), dtype=np.uint8)
+        lengths = np.array([len(raw_bytes) for raw_bytes in raw_alerts], dtype=np.int64)
+        offsets = np.zeros(len(raw_alerts) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        schema_ids = parse_alert_headers(flat, offsets)
+
+        # Decode the payloads in groups sharing a schema, since each schema
+        # needs its own decoding program.
+        parts = []
+        order = []
+        for schema_id in np.unique(schema_ids):
+            program = self._get_forth_program(int(schema_id))
+            indices = np.flatnonzero(schema_ids == schema_id)
+            payloads = np.concatenate([flat[offsets[i] + 5:offsets[i + 1]] for i in indices])
+            parts.append(program.run(payloads, len(indices)))
+            order.append(indices)
+
+        if len(parts) == 1:
+            return parts[0]
+        return ak.concatenate(parts)[np.argsort(np.concatenate(order))]
+
+    def _load_schema(self, schema_id: int) -> dict:
+        # A schema's reader and its Forth program are both built from its
+        # parsed document, which is cached so that building the second
+        # doesn't fetch the schema again.
+        schema = self._document_cache.get(schema_id)
+        if schema is None:
+            schema = self._fetch_schema_document(schema_id)
+            self._document_cache[schema_id] = schema
+        return schema
+
+    def _fetch_schema_document(self, schema_id: int) -> dict:
+        if self._cache_dir is None:
+            return _json.loads(self.get_schema(schema_id))
+
+        path = self._cache_dir / f"{schema_id}.json"
+        try:
+            return _json.loads(path.read_bytes())
+        except FileNotFoundError:
+            pass
+
         schema_bytes = self.get_schema(schema_id)
-        schema = fastavro.parse_schema(json.loads(schema_bytes))
-        self._schema_cache[schema_id] = schema
+        # Only cache documents which parse, so that a bad response isn't
+        # persisted for every process sharing the directory.
+        schema = _json.loads(schema_bytes)
+        # Write to a temporary file and rename it into place, so that other
+        # processes sharing the directory never see a partial file.
+        f = tempfile.NamedTemporaryFile(dir=self._cache_dir, delete=False)
+        try:
+            with f:
+                f.write(schema_bytes)
+            os.replace(f.name, path)
+        except BaseException:
+            os.unlink(f.name)
+            raise
         return schema
 
+    def _get_forth_program(self, schema_id: int) -> ForthProgram:
+        program = self._forth_cache.get(schema_id)
+        if program is not None:
+            return program
+        with self._forth_lock:
+            program = self._forth_cache.get(schema_id)
+            if program is None:
+                program = compile_forth_program(self._load_schema(schema_id))
+                self._forth_cache[schema_id] = program
+        return program
+
+    def _get_schema_reader(self, schema_id: int) -> _SchemaReader:
+        reader = self._schema_cache.get(schema_id)
+        if reader is not None:
+            return reader
+        return self._prefetch_schema(schema_id).result()
+
+    def _start_schema_fetch(self, header: bytes):
+        # Start fetching the schema of an alert which is still downloading.
+        # Corrupted headers are left for the caller to report once the
+        # download finishes.
+        if header[0] != 0:
+            return
+        schema_id = int.from_bytes(header[1:5], "big")
+        if schema_id != self._hot_schema[0] and schema_id not in self._schema_cache:
+            self._prefetch_schema(schema_id)
+
+    def _prefetch_schema(self, schema_id: int) -> Future:
+        with self._schema_futures_lock:
+            future = self._schema_futures.get(schema_id)
+            if future is None:
+                future = self._executor.submit(self._fetch_and_parse_schema, schema_id)
+                self._schema_futures[schema_id] = future
+        return future
+
+    def _fetch_and_parse_schema(self, schema_id: int) -> _SchemaReader:
+        try:
+            # A fetch which just finished may have populated the cache after
+            # the caller checked it.
+            reader = self._schema_cache.get(schema_id)
+            if reader is None:
+                reader = _compile_reader(self._load_schema(schema_id))
+                self._schema_cache[schema_id] = reader
+            return reader
+        finally:
+            with self._schema_futures_lock:
+                del self._schema_futures[schema_id]
+
     @staticmethod
     def _parse_alert_header(alert_raw_bytes: bytes) -> int:
         if len(alert_raw_bytes) < 5:
@@ -169,5 +808,4 @@ class Client:
         magic_byte = alert_raw_bytes[0]
         if magic_byte != 0:
             raise ValueError("alert header has incorrect magic byte, might be corrupted")
-        schema_id = struct.unpack(">I", alert_raw_bytes[1:5])[0]
-        return schema_id
+        return int.from_bytes(alert_raw_bytes[1:5], "big")
@@ -0,0 +1,325 @@
+# This file is part of alert_database_client.
+#
+# Developed for the LSST Data Management System.
+# This product includes software developed by the LSST Project
+# (https://www.lsst.org).
+# See the COPYRIGHT file at the top-level directory of this distribution
+# for details of code ownership.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+Columnar decoding of Avro alert payloads with AwkwardForth.
+
+An Avro schema is translated into an AwkwardForth program which reads a
+stream of concatenated schemaless Avro records and fills one output buffer
+per leaf column, along with the Awkward Array form which describes how those
+buffers fit together. Running the program produces an Awkward Array with one
+entry per record, without ever building per-record Python objects.
+
+awkward and numpy are optional dependencies, and are only imported when
+actually needed.
+"""
+import threading
+from typing import List, Tuple
+
+import fastavro
+
+
+# Avro primitive type -> (AwkwardForth read instruction, output dtype)
+_PRIMITIVES = {
+    "boolean": ("?->", "bool"),
+    "int": ("zigzag->", "int32"),
+    "long": ("zigzag->", "int64"),
+    "float": ("f->", "float32"),
+    "double": ("d->", "float64"),
+}
+
+
+class ForthProgram:
+    """
+    An AwkwardForth program which decodes records of a single Avro schema.
+
+    Parameters
+    ----------
+    source : str
+        AwkwardForth source code. The program expects the number of records
+        to read on top of its stack, and reads them from an input named
+        "stream".
+    form : dict
+        The Awkward Array form, in dictionary representation, of the
+        program's output.
+    """
+
+    def __init__(self, source: str, form: dict):
+        self.source = source
+        self.form = form
+        # The machine is compiled on first use and reused by later runs,
+        # since begin resets it. It can only run one input at a time.
+        self._machine = None
+        self._lock = threading.Lock()
+
+    def run(self, payloads, n_records: int):
+        """
+        Decode n_records concatenated Avro records into an Awkward Array.
+
+        Parameters
+        ----------
+        payloads : bytes or numpy.ndarray
+            Schemaless Avro records, back to back.
+        n_records : int
+            The number of records in payloads.
+
+        Returns
+        -------
+        awkward.Array
+            An array of length n_records.
+
+        Raises
+        ------
+        ValueError
+            If payloads does not hold exactly n_records records of the
+            program's schema.
+        """
+        import awkward as ak
+        import numpy as np
+
+        stream = np.frombuffer(payloads, dtype=np.uint8)
+        with self._lock:
+            if self._machine is None:
+                self._machine = ak.forth.ForthMachine64(self.source)
+            machine = self._machine
+            machine.begin({"stream": stream})
+            machine.stack_push(n_records)
+            machine.resume()
+            consumed = machine.input_position("stream")
+            # begin allocates new output buffers, so these stay valid after
+            # the next run.
+            buffers = {key: np.asarray(value) for key, value in machine.outputs.items()}
+        if consumed != len(stream):
+            raise ValueError(
+                f"decoding {n_records} records consumed {consumed} bytes, "
+                f"but the payloads are {len(stream)} bytes; they might not match the schema"
+            )
+        return ak.from_buffers(ak.forms.from_dict(self.form), n_records, buffers)
+
+
+def parse_alert_headers(flat, offsets):
+    """
+    Parse the Confluent Wire Format headers of many alert packets at once.
+
+    Parameters
+    ----------
+    flat : numpy.ndarray
+        Raw alert packets, back to back, as an array of uint8.
+    offsets : numpy.ndarray
+        The positions in flat where each packet starts, followed by the
+        length of flat, so that packet i is flat[offsets[i]:offsets[i+1]].
+
+    Returns
+    -------
+    numpy.ndarray
+        The schema ID of each packet.
+
+    Raises
+    ------
+    ValueError
+        If any packet is too short or has an incorrect magic byte.
+    """
+    import numpy as np
+
+    starts = offsets[:-1]
+    if np.any(np.diff(offsets) < 5):
+        raise ValueError("corrupted alert data is not in confluent wire format")
+    if np.any(flat[starts] != 0):
+        raise ValueError("alert header has incorrect magic byte, might be corrupted")
+    id_bytes = flat[starts[:, np.newaxis] + np.arange(1, 5)].astype(np.uint32)
+    return (id_bytes[:, 0] << 24) | (id_bytes[:, 1] << 16) | (id_bytes[:, 2] << 8) | id_bytes[:, 3]
+
+
+def compile_forth_program(schema: dict) -> ForthProgram:
+    """
+    Translate an Avro schema into an AwkwardForth decoding program.
+
+    Supported types are the numeric and boolean primitives, strings, bytes,
+    records, arrays, and unions of null with one other type. This covers the
+    Rubin alert packet schemas. Logical types are ignored, so fields are
+    decoded as their underlying type; for example, a timestamp-millis field
+    is decoded as an integer rather than a datetime.
+
+    Parameters
+    ----------
+    schema : dict
+        An Avro schema, as loaded from its JSON representation.
+
+    Returns
+    -------
+    ForthProgram
+        A program which decodes records of the schema.
+
+    Raises
+    ------
+    ValueError
+        If the schema uses a type which cannot be decoded columnarly.
+    """
+    return _ForthBuilder().build(fastavro.schema.expand_schema(schema))
+
+
+class _ForthBuilder:
+    def __init__(self):
+        self._declarations: List[str] = []
+        self._init: List[str] = []
+        self._next_node = 0
+
+    def build(self, schema) -> ForthProgram:
+        body, form = self._generate(schema, depth=1)
+        lines = ["input stream"] + self._declarations + self._init
+        lines += ["0 do"] + body + ["loop"]
+        return ForthProgram("\n".join(lines), form)
+
+    def _new_node(self) -> str:
+        key = f"node{self._next_node}"
+        self._next_node += 1
+        return key
+
+    def _generate(self, schema, depth: int) -> Tuple[List[str], dict]:
+        if isinstance(schema, list):
+            return self._generate_union(schema, depth)
+        if isinstance(schema, str):
+            avro_type = schema
+        else:
+            avro_type = schema["type"]
+            if isinstance(avro_type, (dict, list)):
+                return self._generate(avro_type, depth)
+
+        indent = "  " * depth
+        if avro_type in _PRIMITIVES:
+            instruction, dtype = _PRIMITIVES[avro_type]
+            key = self._new_node()
+            self._declarations.append(f"output {key}-data {dtype}")
+            form = {"class": "NumpyArray", "primitive": dtype, "form_key": key}
+            return [f"{indent}stream {instruction} {key}-data"], form
+        if avro_type in ("string", "bytes"):
+            return self._generate_bytes(avro_type, depth)
+        if avro_type == "record":
+            return self._generate_record(schema, depth)
+        if avro_type == "array":
+            return self._generate_array(schema, depth)
+        raise ValueError(f"Avro type {avro_type!r} is not supported for columnar decoding")
+
+    def _generate_bytes(self, avro_type: str, depth: int) -> Tuple[List[str], dict]:
+        indent = "  " * depth
+        key = self._new_node()
+        content_key = self._new_node()
+        self._declarations.append(f"output {key}-offsets int64")
+        self._declarations.append(f"output {content_key}-data uint8")
+        self._init.append(f"0 {key}-offsets <- stack")
+        if avro_type == "string":
+            list_param, content_param = "string", "char"
+        else:
+            list_param, content_param = "bytestring", "byte"
+        form = {
+            "class": "ListOffsetArray",
+            "offsets": "i64",
+            "parameters": {"__array__": list_param},
+            "form_key": key,
+            "content": {
+                "class": "NumpyArray",
+                "primitive": "uint8",
+                "parameters": {"__array__": content_param},
+                "form_key": content_key,
+            },
+        }
+        body = [
+            f"{indent}stream zigzag-> stack",
+            f"{indent}dup {key}-offsets +<- stack",
+            f"{indent}stream #B-> {content_key}-data",
+        ]
+        return body, form
+
+    def _generate_record(self, schema: dict, depth: int) -> Tuple[List[str], dict]:
+        key = self._new_node()
+        body: List[str] = []
+        fields, contents = [], []
+        for field in schema["fields"]:
+            field_body, field_form = self._generate(field["type"], depth)
+            body += field_body
+            fields.append(field["name"])
+            contents.append(field_form)
+        form = {
+            "class": "RecordArray",
+            "fields": fields,
+            "contents": contents,
+            "form_key": key,
+        }
+        return body, form
+
+    def _generate_array(self, schema: dict, depth: int) -> Tuple[List[str], dict]:
+        # Avro arrays are a series of blocks, each prefixed with an item
+        # count and terminated by an empty block. A negative count is
+        # followed by the block's size in bytes, which is not needed here.
+        # The running total of items is kept on the stack.
+        indent = "  " * depth
+        key = self._new_node()
+        self._declarations.append(f"output {key}-offsets int64")
+        self._init.append(f"0 {key}-offsets <- stack")
+        item_body, item_form = self._generate(schema["items"], depth + 3)
+        body = [
+            f"{indent}0 begin",
+            f"{indent}  stream zigzag-> stack",
+            f"{indent}  dup while",
+            f"{indent}  dup 0 < if negate stream zigzag-> stack drop then",
+            f"{indent}  dup rot + swap",
+            f"{indent}  0 do",
+            *item_body,
+            f"{indent}  loop",
+            f"{indent}repeat",
+            f"{indent}drop {key}-offsets +<- stack",
+        ]
+        form = {
+            "class": "ListOffsetArray",
+            "offsets": "i64",
+            "content": item_form,
+            "form_key": key,
+        }
+        return body, form
+
+    def _generate_union(self, schema: list, depth: int) -> Tuple[List[str], dict]:
+        if len(schema) != 2 or "null" not in schema:
+            raise ValueError(
+                f"union {schema!r} is not supported for columnar decoding; "
+                "only unions of null and one other type are"
+            )
+        indent = "  " * depth
+        null_index = schema.index("null")
+        key = self._new_node()
+        self._declarations.append(f"output {key}-index int64")
+        self._declarations.append(f"variable {key}-count")
+        content_body, content_form = self._generate(schema[1 - null_index], depth + 1)
+        body = [
+            f"{indent}stream zigzag-> stack",
+            f"{indent}{null_index} = if",
+            f"{indent}  -1 {key}-index <- stack",
+            f"{indent}else",
+            f"{indent}  {key}-count @ {key}-index <- stack",
+            f"{indent}  1 {key}-count +!",
+            *content_body,
+            f"{indent}then",
+        ]
+        form = {
+            "class": "IndexedOptionArray",
+            "index": "i64",
+            "content": content_form,
+            "form_key": key,
+        }
+        return body, form
@@ -18,9 +18,15 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import asyncio
+import contextlib
 import gzip
+import http.server
 import io
 import json
+import os
+import sys
+import threading
 
 import fastavro
 import pytest
@@ -28,6 +34,8 @@ import requests
 import responses
 
 from lsst.alert.database.client import Client
+from lsst.alert.database.client._client import _compile_reader, _GzipStreamDecompressor, _LRUCache
+from lsst.alert.database.client._columnar import compile_forth_program, parse_alert_headers
 
 alert_url_expectations = [
     # input base URL, input alertId, expected output
@@ -36,6 +44,8 @@ alert_url_expectations = [
     ("https://localhost/", 1111, "https://localhost/v1/alerts/1111"),
     ("localhost/", 1111, "http://localhost/v1/alerts/1111"),
     ("localhost", 1111, "http://localhost/v1/alerts/1111"),
+    ("localhost:8080", 1111, "http://localhost:8080/v1/alerts/1111"),
+    ("https://alert-db.lsst.codes/some/path", 1111, "https://alert-db.lsst.codes/v1/alerts/1111"),
 ]
 
 
@@ -56,6 +66,8 @@ schema_url_expectations = [
     ("https://localhost/", 1111, "https://localhost/v1/schemas/1111"),
     ("localhost/", 1111, "http://localhost/v1/schemas/1111"),
     ("localhost", 1111, "http://localhost/v1/schemas/1111"),
+    ("localhost:8080", 1111, "http://localhost:8080/v1/schemas/1111"),
+    ("https://alert-db.lsst.codes/some/path", 1111, "https://alert-db.lsst.codes/v1/schemas/1111"),
 ]
 
 
@@ -179,6 +191,55 @@ def test_get_alert(mock_responses):
     assert mock_responses.assert_call_count("http://testdb/v1/schemas/1", 1) is True
 
 
+def test_get_alert_alternating_schemas(mock_responses):
+    # Alerts with schema IDs 1, 2, 1 in sequence should each be decoded with
+    # their own schema, even though the client remembers the last one used.
+    schemas = {
+        1: {
+            "type": "record",
+            "name": "test_alert",
+            "fields": [
+                {"name": "alertId", "type": "long"},
+            ],
+        },
+        2: {
+            "type": "record",
+            "name": "test_alert",
+            "fields": [
+                {"name": "alertId", "type": "long"},
+                {"name": "ra", "type": "double"},
+            ],
+        },
+    }
+    for schema_id, schema in schemas.items():
+        mock_responses.add(
+            responses.GET,
+            f"http://testdb/v1/schemas/{schema_id}",
+            body=json.dumps(schema),
+            status=200,
+            content_type="application/vnd.schemaregistry.v1+json",
+        )
+    alerts = [
+        (1, {"alertId": 1}),
+        (2, {"alertId": 2, "ra": 1.5}),
+        (1, {"alertId": 3}),
+    ]
+    for schema_id, alert in alerts:
+        mock_responses.add(
+            responses.GET,
+            f"http://testdb/v1/alerts/{alert['alertId']}",
+            body=_encode_alert(schemas[schema_id], alert, schema_id),
+            status=200,
+            content_type="application/octet-stream",
+        )
+
+    client = Client("http://testdb")
+    for _, alert in alerts:
+        assert client.get_alert(alert["alertId"]) == alert
+    assert mock_responses.assert_call_count("http://testdb/v1/schemas/1", 1) is True
+    assert mock_responses.assert_call_count("http://testdb/v1/schemas/2", 1) is True
+
+
 def test_parse_alert_header():
     client = Client("http://testdb")
     header = b'\x00\x00\x00\x00\x00'
@@ -203,3 +264,526 @@ def test_parse_alert_header():
         # Wrong magic byte
         header = b"\x01\x00\x00\x00\x00"
         client._parse_alert_header(header)
+
+
+def test_client_context_manager(mock_responses):
+    alert_body = b"zzz"
+    mock_responses.add(
+        responses.GET, "http://testdb/v1/alerts/1111",
+        body=gzip.compress(alert_body), status=200,
+        content_type="application/octet-stream",
+    )
+    with Client("http://testdb/") as client:
+        have = client.get_raw_alert_bytes(1111)
+        assert have == alert_body
+        # Both requests should go through the same session.
+        have = client.get_raw_alert_bytes(1111)
+        assert have == alert_body
+    assert mock_responses.assert_call_count("http://testdb/v1/alerts/1111", 2) is True
+
+
+def _encode_alert(schema, alert, schema_id=1):
+    buf = io.BytesIO()
+    buf.write(b"\x00" + schema_id.to_bytes(4, "big"))
+    fastavro.schemaless_writer(buf, schema, alert)
+    return gzip.compress(buf.getvalue())
+
+
+def test_get_alerts(mock_responses):
+    schema = {
+        "type": "record",
+        "name": "test-alert",
+        "fields": [
+            {"name": "alertId", "type": "long"},
+        ],
+    }
+    mock_responses.add(
+        responses.GET,
+        "http://testdb/v1/schemas/1",
+        body=json.dumps(schema),
+        status=200,
+        content_type="application/vnd.schemaregistry.v1+json",
+    )
+    alerts = [{"alertId": alert_id} for alert_id in range(100, 120)]
+    for alert in alerts:
+        mock_responses.add(
+            responses.GET,
+            f"http://testdb/v1/alerts/{alert['alertId']}",
+            body=_encode_alert(schema, alert),
+            status=200,
+            content_type="application/octet-stream",
+        )
+
+    client = Client("http://testdb", max_connections=4)
+    have = list(client.get_alerts(alert["alertId"] for alert in alerts))
+    assert have == alerts
+    # Concurrent workers should share a single fetch of the schema.
+    assert mock_responses.assert_call_count("http://testdb/v1/schemas/1", 1) is True
+
+
+def test_get_raw_alert_bytes_content_encoding(mock_responses):
+    # The server may additionally compress the stored gzip packet at the
+    # transport layer.
+    alert_body = b"zzz"
+    mock_responses.add(
+        responses.GET, "http://testdb/v1/alerts/1111",
+        body=gzip.compress(gzip.compress(alert_body)), status=200,
+        content_type="application/octet-stream",
+        headers={"Content-Encoding": "gzip"},
+    )
+    client = Client("http://testdb/")
+    have = client.get_raw_alert_bytes(1111)
+    assert have == alert_body
+
+
+@pytest.mark.parametrize("size", [3, 4 << 20])
+def test_get_raw_alert_bytes_parallel(mock_responses, size):
+    alert_body = os.urandom(size)
+    mock_responses.add(
+        responses.GET, "http://testdb/v1/alerts/1111",
+        body=gzip.compress(alert_body), status=200,
+        content_type="application/octet-stream",
+    )
+    client = Client("http://testdb/")
+    have = client.get_raw_alert_bytes(1111, parallel=True)
+    assert have == alert_body
+
+
+@pytest.mark.parametrize("use_avroc", [True, False])
+def test_compile_reader(monkeypatch, use_avroc):
+    if use_avroc:
+        pytest.importorskip("avroc")
+    else:
+        monkeypatch.setitem(sys.modules, "avroc", None)
+    schema = {
+        "type": "record",
+        "name": "test_alert",
+        "fields": [
+            {"name": "alertId", "type": "long"},
+            {"name": "ra", "type": ["null", "double"]},
+        ],
+    }
+    alert = {"alertId": 81023, "ra": 1.5}
+    buf = io.BytesIO()
+    fastavro.schemaless_writer(buf, schema, alert)
+
+    reader = _compile_reader(schema)
+    have = reader(io.BytesIO(buf.getvalue()))
+    assert have == alert
+
+
+def test_get_alerts_columnar(mock_responses):
+    ak = pytest.importorskip("awkward")
+    source = {
+        "type": "record",
+        "name": "diaSource",
+        "fields": [
+            {"name": "ra", "type": "double"},
+            {"name": "psFlux", "type": ["null", "float"]},
+        ],
+    }
+    schemas = {
+        1: {
+            "type": "record",
+            "name": "alert",
+            "fields": [
+                {"name": "alertId", "type": "long"},
+                {"name": "diaSource", "type": source},
+                {"name": "prvDiaSources", "type": ["null", {"type": "array", "items": "diaSource"}]},
+                {"name": "cutoutDifference", "type": ["null", "bytes"]},
+            ],
+        },
+        2: {
+            "type": "record",
+            "name": "alert",
+            "fields": [
+                {"name": "alertId", "type": "long"},
+                {"name": "diaSource", "type": source},
+            ],
+        },
+    }
+    for schema_id, schema in schemas.items():
+        mock_responses.add(
+            responses.GET,
+            f"http://testdb/v1/schemas/{schema_id}",
+            body=json.dumps(schema),
+            status=200,
+            content_type="application/vnd.schemaregistry.v1+json",
+        )
+
+    alerts = []
+    for alert_id in range(10):
+        alert = {
+            "alertId": alert_id,
+            "diaSource": {"ra": alert_id * 1.5, "psFlux": None if alert_id % 3 else 2.0},
+        }
+        if alert_id % 4 == 0:
+            schema_id = 2
+        else:
+            schema_id = 1
+            alert["prvDiaSources"] = [alert["diaSource"]] * alert_id if alert_id % 2 else None
+            alert["cutoutDifference"] = b"x" * alert_id
+        alerts.append(alert)
+        mock_responses.add(
+            responses.GET,
+            f"http://testdb/v1/alerts/{alert_id}",
+            body=_encode_alert(schemas[schema_id], alert, schema_id),
+            status=200,
+            content_type="application/octet-stream",
+        )
+
+    client = Client("http://testdb")
+    have = client.get_alerts_columnar(range(10))
+    assert len(have) == 10
+    assert ak.to_list(have["alertId"]) == list(range(10))
+    assert ak.to_list(have["diaSource", "ra"]) == [a["diaSource"]["ra"] for a in alerts]
+    for have_alert, alert in zip(ak.to_list(have), alerts):
+        assert {k: v for k, v in have_alert.items() if k in alert} == alert
+
+    # Decoding the same alerts one at a time reuses the schema documents
+    # fetched for the columnar decoding.
+    for alert_id in [0, 1]:
+        client.get_alert(alert_id)
+    for schema_id in schemas:
+        assert mock_responses.assert_call_count(f"http://testdb/v1/schemas/{schema_id}", 1) is True
+
+    # No alerts means no schema, so there are no fields.
+    assert len(client.get_alerts_columnar([])) == 0
+
+
+def test_get_alert_bad_magic_byte(mock_responses):
+    mock_responses.add(
+        responses.GET,
+        "http://testdb/v1/alerts/1",
+        body=gzip.compress(b"\x01\x00\x00\x00\x01\x02"),
+        status=200,
+        content_type="application/octet-stream"
+    )
+    client = Client("http://testdb")
+    with pytest.raises(ValueError):
+        client.get_alert(1)
+
+
+def test_lru_cache():
+    cache = _LRUCache(maxsize=2)
+    cache[1] = "a"
+    cache[2] = "b"
+    assert cache.get(1) == "a"
+    # 2 is now the least recently used entry, so it gets evicted.
+    cache[3] = "c"
+    assert 2 not in cache
+    assert cache.get(2) is None
+    assert cache.get(1) == "a"
+    assert cache.get(3) == "c"
+    assert len(cache) == 2
+
+
+def test_schema_disk_cache(mock_responses, tmp_path):
+    schema = {
+        "type": "record",
+        "name": "test_alert",
+        "fields": [
+            {"name": "alertId", "type": "long"},
+        ],
+    }
+    mock_responses.add(
+        responses.GET,
+        "http://testdb/v1/schemas/1",
+        body=json.dumps(schema),
+        status=200,
+        content_type="application/vnd.schemaregistry.v1+json",
+    )
+    for alert_id in (1, 2):
+        mock_responses.add(
+            responses.GET,
+            f"http://testdb/v1/alerts/{alert_id}",
+            body=_encode_alert(schema, {"alertId": alert_id}),
+            status=200,
+            content_type="application/octet-stream",
+        )
+
+    cache_dir = tmp_path / "schemas"
+    client = Client("http://testdb", cache_dir=cache_dir)
+    assert client.get_alert(1) == {"alertId": 1}
+    assert json.loads((cache_dir / "1.json").read_bytes()) == schema
+
+    # A new client, with an empty in-memory cache, should use the schema on
+    # disk rather than fetching it again.
+    client = Client("http://testdb", cache_dir=cache_dir)
+    assert client.get_alert(2) == {"alertId": 2}
+    assert mock_responses.assert_call_count("http://testdb/v1/schemas/1", 1) is True
+
+
+@contextlib.contextmanager
+def _serve_alert_db(schema, alerts):
+    """
+    Serve the given alerts, all encoded with a schema of ID 1, over HTTP on
+    localhost. Yields the server's URL.
+    """
+    bodies = {
+        "/v1/schemas/1": json.dumps(schema).encode(),
+    }
+    for alert in alerts:
+        bodies[f"/v1/alerts/{alert['alertId']}"] = _encode_alert(schema, alert)
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True
+
+        def do_GET(self):
+            body = bodies.get(self.path)
+            if body is None:
+                self.send_response(404)
+                body = b"Not Found"
+            else:
+                self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f"http://127.0.0.1:{server.server_port}"
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_httpx_backend():
+    httpx = pytest.importorskip("httpx")
+    pytest.importorskip("h2")
+    schema = {
+        "type": "record",
+        "name": "test_alert",
+        "fields": [
+            {"name": "alertId", "type": "long"},
+        ],
+    }
+    alerts = [{"alertId": alert_id} for alert_id in range(100, 110)]
+
+    with _serve_alert_db(schema, alerts) as url, Client(url, http_backend="httpx") as client:
+        assert client.get_alert(100) == alerts[0]
+        assert list(client.get_alerts(alert["alertId"] for alert in alerts)) == alerts
+        with pytest.raises(httpx.HTTPStatusError):
+            client.get_raw_alert_bytes(1)
+
+    with pytest.raises(ValueError):
+        Client("http://testdb", http_backend="urllib")
+
+
+def test_get_alerts_async():
+    pytest.importorskip("httpx")
+    pytest.importorskip("h2")
+    schema = {
+        "type": "record",
+        "name": "test_alert",
+        "fields": [
+            {"name": "alertId", "type": "long"},
+        ],
+    }
+    alerts = [{"alertId": alert_id} for alert_id in range(100, 300)]
+
+    # Many more alerts than connections should queue, rather than time out
+    # waiting for a connection.
+    with _serve_alert_db(schema, alerts) as url, Client(url, max_connections=2) as client:
+        have = asyncio.run(client.get_alerts_async(alert["alertId"] for alert in alerts))
+    assert have == alerts
+
+
+def test_parse_alert_headers():
+    np = pytest.importorskip("numpy")
+    packets = [b"\x00\x00\x00\x00\x09abc", b"\x00\x01\x02\x03\x04", b"\x00\xff\xff\xff\xffxyz"]
+    flat = np.frombuffer(b"".join(packets), dtype=np.uint8)
+    offsets = np.cumsum([0] + [len(p) for p in packets])
+    have = parse_alert_headers(flat, offsets)
+    assert have.tolist() == [Client._parse_alert_header(p) for p in packets]
+
+    with pytest.raises(ValueError):
+        # Too short
+        packets = [b"\x00\x00\x00\x00\x09abc", b"\x00\x00\x00"]
+        flat = np.frombuffer(b"".join(packets), dtype=np.uint8)
+        parse_alert_headers(flat, np.array([0, 8, 11]))
+
+    with pytest.raises(ValueError):
+        # Wrong magic byte
+        packets = [b"\x00\x00\x00\x00\x09abc", b"\x01\x00\x00\x00\x00"]
+        flat = np.frombuffer(b"".join(packets), dtype=np.uint8)
+        parse_alert_headers(flat, np.array([0, 8, 13]))
+
+
+def test_close():
+    client = Client("http://testdb")
+    client.close()
+    # Closing twice is harmless.
+    client.close()
+    assert client._executor._shutdown
+
+    # A closed client refuses to make requests, rather than failing half way
+    # through one.
+    for method in [client.get_alert, client.get_raw_alert_bytes, client.get_schema]:
+        with pytest.raises(RuntimeError, match="client is closed"):
+            method(1)
+    with pytest.raises(RuntimeError, match="client is closed"):
+        asyncio.run(client.get_alerts_async([1]))
+
+
+def test_get_raw_alert_bytes_on_header(mock_responses):
+    # The header is reported exactly once, although the packet arrives in
+    # many chunks.
+    packet = b"\x00\x00\x00\x00\x07" + os.urandom(300_000)
+    mock_responses.add(
+        responses.GET, "http://testdb/v1/alerts/1111",
+        body=gzip.compress(packet), status=200,
+        content_type="application/octet-stream",
+    )
+    client = Client("http://testdb/")
+    headers = []
+    assert client._get_raw_alert_bytes(1111, on_header=headers.append) == packet
+    assert headers == [packet[:5]]
+
+
+def test_get_raw_alert_bytes_bad_content_encoding(mock_responses):
+    # A body which claims a transport-level gzip encoding, but isn't gzip,
+    # should raise a requests exception.
+    mock_responses.add(
+        responses.GET, "http://testdb/v1/alerts/1111",
+        body=b"not gzip", status=200,
+        content_type="application/octet-stream",
+        headers={"Content-Encoding": "gzip"},
+    )
+    client = Client("http://testdb/")
+    with pytest.raises(requests.exceptions.ContentDecodingError):
+        client.get_raw_alert_bytes(1111)
+
+
+def test_decompress_matches_gzip():
+    # Multi-member gzip data should decompress to the concatenated members,
+    # whether or not the members are the same size.
+    compressed = gzip.compress(b"abc") + gzip.compress(b"def")
+    assert Client._decompress(compressed) == b"abcdef"
+    compressed = gzip.compress(b"abc") + gzip.compress(b"defgh")
+    assert Client._decompress(compressed) == b"abcdefgh"
+
+    have = Client._decompress(gzip.compress(b"abc"))
+    assert have == b"abc"
+    assert type(have) is bytes
+
+    # Truncated data should raise the same exception as the gzip module.
+    truncated = gzip.compress(b"hello world" * 100)[:-10]
+    with pytest.raises(EOFError):
+        Client._decompress(truncated)
+
+    assert Client._decompress(b"") == b""
+
+    # So should data which isn't gzip, or is corrupted, even though isal
+    # raises different exceptions for some of it.
+    compressed = gzip.compress(b"hello world" * 100)
+    for data in [b"not gzip", b"\x1f", compressed + b"xx", compressed[:-8] + bytes(4) + compressed[-4:]]:
+        with pytest.raises(gzip.BadGzipFile):
+            Client._decompress(data)
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 1 << 16])
+def test_gzip_stream_decompressor(chunk_size):
+    def decompress(data):
+        decompressor = _GzipStreamDecompressor()
+        for i in range(0, len(data), chunk_size):
+            decompressor.feed(data[i:i + chunk_size])
+        return decompressor.finish()
+
+    members = [gzip.compress(b"abc"), gzip.compress(b"defgh" * 1000), gzip.compress(b"")]
+    for data in [b"", members[0], b"".join(members), members[0] + b"\x00" * 9 + members[1]]:
+        assert decompress(data) == gzip.decompress(data)
+
+    for data in [b"not gzip", members[0] + b"xx", members[0][:-8] + bytes(4) + members[0][-4:]]:
+        with pytest.raises(gzip.BadGzipFile):
+            decompress(data)
+    with pytest.raises(EOFError):
+        decompress(members[1][:-10])
+    with pytest.raises(EOFError):
+        decompress(members[0] + members[1][:1])
+
+
+def test_get_raw_alert_bytes_streamed_members(mock_responses):
+    # The body is decompressed as it streams in, across chunk boundaries
+    # and gzip member boundaries.
+    expected = os.urandom(200_000)
+    body = gzip.compress(expected[:70_000]) + gzip.compress(expected[70_000:])
+    mock_responses.add(
+        responses.GET, "http://testdb/v1/alerts/1111",
+        body=body, status=200,
+        content_type="application/octet-stream",
+    )
+    client = Client("http://testdb/")
+    assert client.get_raw_alert_bytes(1111) == expected
+
+
+def test_schema_disk_cache_invalid_schema(mock_responses, tmp_path):
+    # A response which isn't JSON shouldn't be persisted in the cache.
+    mock_responses.add(
+        responses.GET,
+        "http://testdb/v1/schemas/1",
+        body=b"<html>Bad Gateway</html>",
+        status=200,
+    )
+    client = Client("http://testdb", cache_dir=tmp_path)
+    with pytest.raises(ValueError):
+        client._load_schema(1)
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_schema_disk_cache_failed_write(mock_responses, tmp_path, monkeypatch):
+    mock_responses.add(
+        responses.GET,
+        "http://testdb/v1/schemas/1",
+        body=b'{"type": "string"}',
+        status=200,
+    )
+
+    def fail_replace(src, dst):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(os, "replace", fail_replace)
+    client = Client("http://testdb", cache_dir=tmp_path)
+    with pytest.raises(OSError):
+        client._load_schema(1)
+    # The temporary file should have been cleaned up.
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_forth_program_payload_mismatch():
+    pytest.importorskip("awkward")
+    schema = {
+        "type": "record",
+        "name": "test_alert",
+        "fields": [
+            {"name": "alertId", "type": "long"},
+            {"name": "name", "type": "string"},
+        ],
+    }
+    buf = io.BytesIO()
+    fastavro.schemaless_writer(buf, schema, {"alertId": 1, "name": "abc"})
+    payload = buf.getvalue()
+    program = compile_forth_program(schema)
+    assert program.run(payload, 1).tolist() == [{"alertId": 1, "name": "abc"}]
+
+    with pytest.raises(ValueError):
+        # Trailing junk
+        program.run(payload + b"\x00\x01", 1)
+
+    with pytest.raises(ValueError):
+        # Truncated
+        program.run(payload[:-1], 1)
+
+    # The program's machine is reused, so a failed run mustn't affect later
+    # ones, and a run mustn't overwrite the results of earlier ones.
+    first = program.run(payload, 1)
+    buf = io.BytesIO()
+    fastavro.schemaless_writer(buf, schema, {"alertId": 2, "name": "de"})
+    assert program.run(buf.getvalue(), 1).tolist() == [{"alertId": 2, "name": "de"}]
+    assert first.tolist() == [{"alertId": 1, "name": "abc"}]